@@ -6,9 +6,12 @@ import csv
 import io
 import re
 import math
+import time
+import threading
 import unicodedata
-from datetime import datetime, timedelta
-from functools import wraps
+from datetime import datetime, timedelta, timezone
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import uuid
 import mimetypes
@@ -34,6 +37,8 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-change-me")
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# На Railway персистентный том смонтирован в /data — там живут БД и вложения
+_RAILWAY = os.path.isdir("/data")
 
 def _compute_db_uri() -> str:
     raw = os.getenv("DATABASE_URL")
@@ -49,7 +54,7 @@ def _compute_db_uri() -> str:
             raw = f"{raw}{sep}sslmode=require"
         return raw
 
-    if os.path.exists("/data"):
+    if _RAILWAY:
         return "sqlite:////data/site.db"
     return "sqlite:///" + os.path.join(BASE_DIR, "site.db")
 
@@ -64,7 +69,7 @@ login_manager.init_app(app)
 
 # ===== Uploads =====
 # Храним файлы в персистентной папке (/data на Railway), локально — ./uploads
-if os.path.exists("/data"):
+if _RAILWAY:
     UPLOAD_DIR = Path("/data/uploads")
 else:
     UPLOAD_DIR = Path(BASE_DIR) / "uploads"
@@ -72,6 +77,9 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 # Ограничение размера (16 МБ)
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+_UPLOAD_CHUNK = 64 * 1024  # вложения пишутся на диск кусками такого размера
+# За nginx/прокси с X-Sendfile файлы отдаёт сам прокси, байты не идут через Python
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
 
 ALLOWED_EXTS = {
     "pdf", "doc", "docx", "ppt", "pptx", "xls", "xlsx",
@@ -103,6 +111,12 @@ def force_auth_for_all():
         return
     return redirect(url_for("login", next=request.url))
 
+# ======================= HTTP =======================
+# Одна сессия на процесс: keep-alive к docs.google.com / api.telegram.org
+# вместо нового TCP+TLS на каждый запрос
+_HTTP = requests.Session()
+_HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
 # ======================= Sheets config =======================
 SHEETS = [
     {
@@ -126,7 +140,19 @@ SHEETS = [
         "prefer_total": True,
     },
 ]
-DEADLINE_TYPES = ["кр", "лаба", "дз", "тр", "тест", "коллок"]
+DEADLINE_TYPES = ["кр", "лаба", "дз", "тр", "тест", "коллок"]  # порядок — для шаблонов
+_DEADLINE_TYPES_SET = frozenset(DEADLINE_TYPES)                  # для проверок `in`
+
+# Локальное время группы (Питер/Москва, UTC+3)
+MSK_TZ = ZoneInfo("Europe/Moscow")
+UTC = timezone.utc
+
+def _utcnow() -> datetime:
+    """Текущее UTC без tzinfo: колонки DateTime в БД хранят наивное UTC."""
+    return datetime.now(UTC).replace(tzinfo=None)
+
+# Хэш пароля проверяется только в /login: дальше вход держится на сессии Flask-Login
+PASSWORD_HASH_METHOD = "scrypt"
 
 # ======================= Models =======================
 class User(db.Model, UserMixin):
@@ -134,28 +160,32 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     surname = db.Column(db.String(120), nullable=False, default="")
     password_hash = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=_utcnow)
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
     tg_id = db.Column(db.BigInteger, nullable=True, index=True)
     tg_username = db.Column(db.String(255), nullable=True)
 
     def set_password(self, pwd: str) -> None:
-        self.password_hash = generate_password_hash(pwd)
+        self.password_hash = generate_password_hash(pwd, method=PASSWORD_HASH_METHOD, salt_length=16)
 
     def check_password(self, pwd: str) -> bool:
         return check_password_hash(self.password_hash, pwd)
 
+    def password_needs_rehash(self) -> bool:
+        # старые хэши (pbkdf2 от прошлых версий Werkzeug) переводим на scrypt при входе
+        return not self.password_hash.startswith(PASSWORD_HASH_METHOD + ":")
+
 class Deadline(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
-    due_at = db.Column(db.DateTime, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False, index=True)
     all_day = db.Column(db.Boolean, default=False)
     subject = db.Column(db.String(120), nullable=True)
     kind = db.Column(db.String(30), nullable=False, default="дз")
     link = db.Column(db.String(500), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=_utcnow)
     # --- attachment ---
-    file_path = db.Column(db.String(500), nullable=True)  # относительный путь/имя на диске
+    file_path = db.Column(db.String(500), nullable=True, index=True)  # относительный путь/имя на диске
     file_name = db.Column(db.String(255), nullable=True)  # «человеческое» имя
     file_size = db.Column(db.Integer, nullable=True)
     file_mime = db.Column(db.String(120), nullable=True)
@@ -165,6 +195,13 @@ def load_user(user_id: str):
     return User.query.get(int(user_id))
 
 # ======================= Helpers =======================
+_DOC_ID_RE = re.compile(r"/spreadsheets/d/([^/]+)/")
+_GID_RE = re.compile(r"[?&]gid=(\d+)")
+_WS_RE = re.compile(r"\s+")
+_NON_NAME_RE = re.compile(r"[^а-я ]+")  # в имени оставляем только строчную кириллицу и пробелы
+_LAB_RE = re.compile(r"\bлр\s*\d+")
+_ITOG_PAREN_RE = re.compile(r"итог\s*\([^)]*\)")
+
 def _save_upload(fs) -> tuple[str, str, int, str] | None:
     """Сохраняет FileStorage fs в UPLOAD_DIR с уникальным именем."""
     if not fs or fs.filename == "":
@@ -175,9 +212,13 @@ def _save_upload(fs) -> tuple[str, str, int, str] | None:
     ext = orig.rsplit(".", 1)[1].lower()
     stored = f"{uuid.uuid4().hex}.{ext}"
     target = UPLOAD_DIR / stored
-    fs.save(target)
-    size = target.stat().st_size
-    mime = mimetypes.guess_type(orig)[0] or "application/octet-stream"
+    # пишем кусками по 64 КБ и сразу считаем размер — без повторного stat()
+    size = 0
+    with open(target, "wb") as f:
+        while chunk := fs.stream.read(_UPLOAD_CHUNK):
+            f.write(chunk)
+            size += len(chunk)
+    mime = mimetypes.guess_type(orig, strict=False)[0] or "application/octet-stream"
     return (stored, orig, size, mime)
 
 def _remove_upload(stored_name: str | None):
@@ -198,37 +239,122 @@ def admin_required(view):
     return wrapped
 
 def gsheet_to_csv_url(edit_url: str) -> str:
-    m = re.search(r"/spreadsheets/d/([^/]+)/", edit_url)
+    m = _DOC_ID_RE.search(edit_url)
     if not m:
         raise ValueError("Некорректная ссылка на Google Sheets")
     doc_id = m.group(1)
-    m2 = re.search(r"[?&]gid=(\d+)", edit_url)
+    m2 = _GID_RE.search(edit_url)
     gid = m2.group(1) if m2 else "0"
     return f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv&gid={gid}"
 
+def _fetch_csv(
+    csv_url: str,
+    etag: str | None = None,
+    last_modified: str | None = None,
+) -> tuple[list[list[str]] | None, str | None, str | None]:
+    """Условный GET выгрузки: (строки или None при 304, ETag, Last-Modified)."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    # CSV разбирается прямо из сокета, без копии всего тела в памяти
+    with _HTTP.get(csv_url, timeout=20, stream=True, headers=headers) as r:
+        if r.status_code == 304:
+            return None, etag, last_modified
+        r.raise_for_status()
+        r.raw.decode_content = True  # gzip распаковывается на лету
+        r.raw.auto_close = False     # иначе io-обёртки видят закрытый файл на EOF
+        stream = io.TextIOWrapper(
+            io.BufferedReader(r.raw, buffer_size=16 * 1024),
+            encoding="utf-8", errors="ignore", newline="",
+        )
+        rows = [row for row in csv.reader(stream)]
+        return rows, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
 def fetch_csv_rows(csv_url: str) -> list[list[str]]:
-    r = requests.get(csv_url, timeout=20)
-    r.raise_for_status()
-    data = r.content.decode("utf-8", errors="ignore")
-    reader = csv.reader(io.StringIO(data))
-    return [row for row in reader]
+    return _fetch_csv(csv_url)[0]
+
+# ---- Кэш таблиц: баллы меняются раз в часы, а /api/scores дёргают постоянно ----
+SHEETS_CACHE_TTL = int(os.getenv("SHEETS_CACHE_TTL", "300"))  # секунд
+_ROWS_CACHE_MAX = 32
+_SCORES_CACHE_MAX = 4096
+
+_rows_cache: dict[str, tuple[float, dict]] = {}
+_scores_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_cache_lock = threading.Lock()
+_fetch_locks: dict[str, threading.Lock] = {}
+
+def _cache_get(cache: dict, key):
+    with _cache_lock:
+        hit = cache.get(key)
+    if hit and time.monotonic() - hit[0] < SHEETS_CACHE_TTL:
+        return hit[1]
+    return None
+
+def _cache_put(cache: dict, key, value, maxsize: int) -> None:
+    with _cache_lock:
+        cache.pop(key, None)
+        while len(cache) >= maxsize:
+            cache.pop(next(iter(cache)))  # самая старая запись
+        cache[key] = (time.monotonic(), value)
+
+def _fetch_lock(csv_url: str) -> threading.Lock:
+    with _cache_lock:
+        return _fetch_locks.setdefault(csv_url, threading.Lock())
+
+def get_sheet(csv_url: str) -> dict:
+    """Строки листа вместе с индексом по фамилиям (см. build_sheet_index), с TTL-кэшем по URL."""
+    sheet = _cache_get(_rows_cache, csv_url)
+    if sheet is not None:
+        return sheet
+    # один поток качает, остальные ждут его результат, а не идут в Google сами
+    with _fetch_lock(csv_url):
+        sheet = _cache_get(_rows_cache, csv_url)
+        if sheet is not None:
+            return sheet
+        # запись протухла: переспрашиваем Google с её ETag/Last-Modified —
+        # если лист не менялся, придёт пустой 304 и старый индекс живёт дальше
+        with _cache_lock:
+            stale = _rows_cache.get(csv_url)
+        stale = stale[1] if stale else None
+        if stale:
+            rows, etag, last_modified = _fetch_csv(csv_url, stale["etag"], stale["last_modified"])
+        else:
+            rows, etag, last_modified = _fetch_csv(csv_url)
+        if rows is None:
+            sheet = stale
+        else:
+            sheet = build_sheet_index(rows)
+            sheet["etag"], sheet["last_modified"] = etag, last_modified
+        _cache_put(_rows_cache, csv_url, sheet, _ROWS_CACHE_MAX)
+        return sheet
+
+def clear_sheets_cache() -> None:
+    with _cache_lock:
+        _rows_cache.clear()
+        _scores_cache.clear()
 
 def _norm(s: str) -> str:
     s = (s or "")
     s = unicodedata.normalize("NFKC", s)
     s = s.replace("\xa0", " ")
-    return re.sub(r"\s+", " ", s.strip().lower())
+    return _WS_RE.sub(" ", s.strip().lower())
 
-def _norm_name(s: str) -> str:
+def _norm_row_text(s: str) -> str:
     s = _norm(s).replace("ё", "е")
-    keep = []
-    for ch in s:
-        if "а" <= ch <= "я" or ch == " ":
-            keep.append(ch)
-    return re.sub(r"\s+", " ", "".join(keep)).strip()
+    return _WS_RE.sub(" ", _NON_NAME_RE.sub("", s)).strip()
+
+@lru_cache(maxsize=4096)
+def _norm_name(s: str) -> str:
+    # кэш — только для фамилий, они повторяются от запроса к запросу;
+    # тексты строк листа одноразовые, их build_sheet_index нормализует через _norm_row_text
+    return _norm_row_text(s)
 
 def _safe_number(cell: str):
     s = (cell or "").strip().replace(",", ".")
+    if not s:
+        return None  # пустые ячейки — большинство в ведомости; не доводим до исключения
     try:
         v = float(s)
     except ValueError:
@@ -241,14 +367,15 @@ def _safe_number(cell: str):
 
 def _find_header_row(rows: list[list[str]]) -> int:
     for i, row in enumerate(rows[:10]):
-        n = [_norm(c) for c in row]
         if not row:
             continue
-        if any(k in (n[0] if n else "") for k in ("фио", "студент", "фамилия")):
-            return i
-        if any("итог" in c or "total" in c for c in n):
+        n0 = _norm(row[0])
+        if any(k in n0 for k in ("фио", "студент", "фамилия")):
             return i
-        if any(re.search(r"\bлр\s*\d+", c) for c in n):
+        # нормализуем строку один раз; "|" не пробел и не буква,
+        # так что ни одна проверка не сработает на стыке двух ячеек
+        joined = "|".join([n0] + [_norm(c) for c in row[1:]])
+        if "итог" in joined or "total" in joined or _LAB_RE.search(joined):
             return i
     for i, row in enumerate(rows):
         if any((c or "").strip() for c in row):
@@ -263,7 +390,7 @@ def _find_preferred_total_index(headers: list[str]) -> int | None:
         hj = _norm(h)
         if not hj:
             continue
-        if hj == "итог" or re.fullmatch(r"итог\s*\([^)]*\)", hj) or hj == "total":
+        if hj == "итог" or _ITOG_PAREN_RE.fullmatch(hj) or hj == "total":
             ranks.append((1, j))
         elif hj.startswith("итог ") or hj.startswith("total "):
             ranks.append((2, j))
@@ -275,31 +402,71 @@ def _find_preferred_total_index(headers: list[str]) -> int | None:
     candidates = [idx for r, idx in ranks if r == best]
     return max(candidates)
 
+def _total_bounds(headers: list[str]) -> tuple[int | None, int]:
+    """Колонка «Итог» и граница, до которой суммируются баллы."""
+    total_idx = _find_preferred_total_index(headers)
+    stop_at = total_idx if total_idx is not None else (len(headers) if headers else 10**9)
+    return total_idx, stop_at
+
+def build_sheet_index(rows: list[list[str]]) -> dict:
+    """Нормализует строки листа один раз, чтобы поиск студента не повторял это на каждый запрос.
+
+    by_token: первое слово строки (обычно фамилия) -> (индекс строки, текст строки);
+    texts: (индекс строки, текст строки) по порядку — для поиска по подстроке;
+    found: уже найденные цели -> индекс строки (или None), живёт столько же, сколько лист.
+    """
+    hdr_idx = _find_header_row(rows) if rows else 0
+    total_idx, stop_at = _total_bounds(rows[hdr_idx] if hdr_idx < len(rows) else [])
+    by_token: dict[str, tuple[int, str]] = {}
+    texts: list[tuple[int, str]] = []
+    for i in range(hdr_idx + 1, len(rows)):
+        row = rows[i]
+        if not row:
+            continue
+        row_text = _norm_row_text(" ".join((c or "") for c in row))
+        if not row_text:
+            continue
+        texts.append((i, row_text))
+        by_token.setdefault(row_text.split(" ", 1)[0], (i, row_text))
+    return {
+        "rows": rows, "hdr_idx": hdr_idx, "total_idx": total_idx, "stop_at": stop_at,
+        "by_token": by_token, "texts": texts, "found": {},
+    }
+
+def _lookup_row(index: dict, target: str) -> int | None:
+    found = index["found"]
+    if target in found:
+        return found[target]
+    hit = index["by_token"].get(target.split(" ", 1)[0])
+    if hit and target in hit[1]:
+        row_idx = hit[0]
+    else:
+        # промах по первому слову: студента в листе может не быть вовсе,
+        # поэтому запоминаем и результат полного прохода, включая None
+        row_idx = next((i for i, row_text in index["texts"] if target in row_text), None)
+    found[target] = row_idx
+    return row_idx
+
 def find_score_by_surname(
     rows: list[list[str]],
     surname: str,
     prefer_total: bool = False,
     sum_until_total: bool = False,
     take_last_total: bool = False,
+    index: dict | None = None,
 ) -> dict | None:
     if not rows:
         return None
 
-    hdr_idx = _find_header_row(rows)
-    headers = rows[hdr_idx] if hdr_idx < len(rows) else []
-
-    total_idx = _find_preferred_total_index(headers)
-    stop_at = total_idx if total_idx is not None else (len(headers) if headers else 10**9)
+    # без готового индекса строим его тут же: поиск строки всегда идёт через _lookup_row
+    if index is None:
+        index = build_sheet_index(rows)
+    total_idx, stop_at = index["total_idx"], index["stop_at"]
 
     target = _norm_name(surname)
-    row_idx = None
-    for i, row in enumerate(rows[hdr_idx + 1:], start=hdr_idx + 1):
-        if not row:
-            continue
-        row_text = _norm_name(" ".join((c or "") for c in row))
-        if target and target in row_text:
-            row_idx = i
-            break
+    if not target:
+        return None
+    row_idx = _lookup_row(index, target)
     if row_idx is None:
         return None
 
@@ -313,12 +480,7 @@ def find_score_by_surname(
         return None
 
     def _sum_left_until_total() -> dict:
-        end = min(stop_at, len(row))
-        vals = []
-        for j in range(0, end):
-            v = _safe_number(row[j])
-            if v is not None:
-                vals.append(v)
+        vals = [v for v in map(_safe_number, row[:stop_at]) if v is not None]
         return {"sum": round(sum(vals), 3), "values": vals, "row": row}
 
     if prefer_total and total_idx is not None and total_idx < len(row):
@@ -332,33 +494,59 @@ def find_score_by_surname(
 
     return _sum_left_until_total()
 
+# Листы качаются параллельно: запросы к Google — чистый I/O, поток на лист
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=len(SHEETS), thread_name_prefix="sheets")
+
+def score_for_sheet(sheet: dict, surname: str) -> dict:
+    """Баллы по одному листу в формате элемента /api/scores (ошибки — в ok: False)."""
+    key = (sheet["url"], _norm_name(surname))
+    item = _cache_get(_scores_cache, key)
+    if item is not None:
+        return item
+    try:
+        csv_url = gsheet_to_csv_url(sheet["url"])
+        data = get_sheet(csv_url)
+        found = find_score_by_surname(
+            data["rows"],
+            surname,
+            prefer_total=sheet.get("prefer_total", False),
+            sum_until_total=sheet.get("sum_until_total", False),
+            take_last_total=sheet.get("take_last_total", False),
+            index=data,
+        )
+        if found:
+            item = {"name": sheet["name"], "score": round(found["sum"], 3), "ok": True}
+        else:
+            item = {"name": sheet["name"], "score": None, "ok": False}
+    except Exception as e:
+        # ошибки не кэшируем — следующий запрос попробует снова
+        return {"name": sheet["name"], "score": None, "ok": False, "error": str(e)}
+    _cache_put(_scores_cache, key, item, _SCORES_CACHE_MAX)
+    return item
+
 # ======================= Pages =======================
+# Приветствие по локальному часу: 0–4 ночь, 5–11 утро, 12–17 день, 18–23 вечер
+_GREET = ("Доброй ночи",) * 5 + ("Доброе утро",) * 7 + ("Добрый день",) * 6 + ("Добрый вечер",) * 6
+HOME_UPCOMING_LIMIT = 50
+
 @app.route("/")
 @login_required
 def home():
-    # --- UTC для запросов в БД (как было) ---
-    utc_now = datetime.utcnow()
+    # Один замер времени: наивное UTC — для запросов в БД, МСК — для шаблона
+    now_aware = datetime.now(UTC)
+    utc_now = now_aware.replace(tzinfo=None)
     horizon = utc_now + timedelta(days=10)
     upcoming = (
         Deadline.query
         .filter(Deadline.due_at >= utc_now, Deadline.due_at <= horizon)
         .order_by(Deadline.due_at.asc())
+        .limit(HOME_UPCOMING_LIMIT)
         .all()
     )
 
     # --- Локальное время для Питера/Москвы (UTC+3) ---
-    now = datetime.now(ZoneInfo("Europe/Moscow"))
-
-    # Приветствие по локальному часу
-    hour = now.hour
-    if 5 <= hour < 12:
-        greet = "Доброе утро"
-    elif 12 <= hour < 18:
-        greet = "Добрый день"
-    elif 18 <= hour < 24:
-        greet = "Добрый вечер"
-    else:
-        greet = "Доброй ночи"
+    now = now_aware.astimezone(MSK_TZ)
+    greet = _GREET[now.hour]
 
     # Обращение по username (без фамилии)
     uname = current_user.username
@@ -376,23 +564,22 @@ def subjects_page():
 def calendar_page():
     return render_template("calendar.html")
 
-def _format_deadline_title(d: Deadline) -> str:
-    tag = f"[{d.kind}]" if d.kind else ""
-    if d.subject:
-        return f"{tag} {d.subject}: {d.title}".strip()
-    return f"{tag} {d.title}".strip()
+def format_deadline_title(d) -> str:
+    """«[вид] Предмет: Название» — общий формат для календаря, рассылок сайта и бота."""
+    # поля приходят из формы уже без крайних пробелов, так что .strip() не нужен
+    body = f"{d.subject}: {d.title}" if d.subject else d.title
+    return f"[{d.kind}] {body}" if d.kind else body
 
 def _clean_url(u: str | None) -> str | None:
-    if not u:
-        return None
-    u = u.strip()
-    if not u:
+    u = (u or "").strip()
+    # пустое и «не ссылка» отсекаем по префиксу, urlparse — только для похожих на URL
+    if not u[:8].lower().startswith(("http://", "https://")):
         return None
     try:
         p = urlparse(u)
     except Exception:
         return None
-    if p.scheme in ("http", "https") and p.netloc:
+    if p.netloc:
         return u[:500]
     return None
 
@@ -402,7 +589,14 @@ def _slug(s: str) -> str:
 @app.get("/events")
 @login_required
 def events_feed():
-    items = Deadline.query.order_by(Deadline.due_at.asc()).all()
+    # только нужные колонки, без ORM-объектов: фид лишь перекладывает поля в JSON
+    items = db.session.execute(
+        db.select(
+            Deadline.id, Deadline.title, Deadline.due_at, Deadline.all_day,
+            Deadline.subject, Deadline.kind, Deadline.link,
+            Deadline.file_path, Deadline.file_name, Deadline.file_size, Deadline.file_mime,
+        ).order_by(Deadline.due_at.asc())
+    ).all()
 
     def fmt_dt(dt): return dt.strftime("%Y-%m-%dT%H:%M:%S")
     def fmt_d(d):   return d.strftime("%Y-%m-%d")
@@ -417,12 +611,12 @@ def events_feed():
             end   = fmt_dt(d.due_at + timedelta(minutes=1))
 
         # абсолютная ссылка на вложение (если есть)
-        attachment_url = url_for("download_attachment", fname=d.file_path, _external=True) if d.file_path else None
+        attachment_url = url_for("download_attachment", deadline_id=d.id, fname=d.file_path, _external=True) if d.file_path else None
         event_url = d.link or attachment_url
 
         payload.append({
             "id": d.id,
-            "title": _format_deadline_title(d),
+            "title": format_deadline_title(d),
             "start": start,
             "end": end,
             "allDay": bool(d.all_day),
@@ -468,17 +662,29 @@ def admin_user_promote(user_id):
         flash("Пользователь уже админ", "error")
     return redirect(url_for("admin_users"))
 
+def _user_and_admin_count_or_404(user_id: int) -> tuple[User, int]:
+    """Пользователь и общее число админов — одним запросом, а не двумя."""
+    admins = (
+        db.select(db.func.count(User.id))
+        .where(User.is_admin.is_(True))
+        .scalar_subquery()
+    )
+    row = db.session.execute(db.select(User, admins).where(User.id == user_id)).first()
+    if row is None:
+        abort(404)
+    return row[0], row[1]
+
 @app.post("/admin/users/<int:user_id>/demote")
 @admin_required
 def admin_user_demote(user_id):
-    u = User.query.get_or_404(user_id)
+    u, admin_count = _user_and_admin_count_or_404(user_id)
     if not u.is_admin:
         flash("Пользователь и так не админ", "error")
         return redirect(url_for("admin_users"))
     if u.id == current_user.id:
         flash("Нельзя снять админа с самого себя", "error")
         return redirect(url_for("admin_users"))
-    if User.query.filter_by(is_admin=True).count() <= 1:
+    if admin_count <= 1:
         flash("Нельзя снять статус с последнего админа", "error")
         return redirect(url_for("admin_users"))
     u.is_admin = False
@@ -489,11 +695,11 @@ def admin_user_demote(user_id):
 @app.post("/admin/users/<int:user_id>/delete")
 @admin_required
 def admin_user_delete(user_id):
-    u = User.query.get_or_404(user_id)
+    u, admin_count = _user_and_admin_count_or_404(user_id)
     if u.id == current_user.id:
         flash("Нельзя удалить свой аккаунт", "error")
         return redirect(url_for("admin_users"))
-    if u.is_admin and User.query.filter_by(is_admin=True).count() <= 1:
+    if u.is_admin and admin_count <= 1:
         flash("Нельзя удалить последнего админа", "error")
         return redirect(url_for("admin_users"))
     db.session.delete(u)
@@ -512,7 +718,7 @@ def admin_add_deadline():
         subject = (request.form.get("subject") or "").strip() or None
         kind = (request.form.get("kind") or "дз").strip().lower()
         link = _clean_url(request.form.get("link"))
-        if kind not in DEADLINE_TYPES:
+        if kind not in _DEADLINE_TYPES_SET:
             kind = "дз"
 
         if not title or not date:
@@ -550,13 +756,13 @@ def admin_add_deadline():
         if token:
             try:
                 text_msg = (
-                    f"🆕 Новый дедлайн: { _format_deadline_title(d) }\n"
+                    f"🆕 Новый дедлайн: { format_deadline_title(d) }\n"
                     f"Когда: { d.due_at.strftime('%d.%m.%Y %H:%M') if not d.all_day else d.due_at.strftime('%d.%m.%Y') }"
                 )
                 # соберём tg_id всех привязанных
                 chat_ids = [u.tg_id for u in User.query.filter(User.tg_id.isnot(None)).all()]
                 for cid in chat_ids:
-                    requests.post(
+                    _HTTP.post(
                         f"https://api.telegram.org/bot{token}/sendMessage",
                         json={"chat_id": cid, "text": text_msg}
                     )
@@ -574,28 +780,6 @@ def admin_deadlines_list():
     items = Deadline.query.order_by(Deadline.due_at.asc()).all()
     return render_template("admin_deadlines.html", items=items)
 
-# ====== Глобальный гейт для гостей ======
-PUBLIC_ENDPOINTS = {
-    "login",
-    "register",
-    "static",
-    "not_found",
-    "forbidden",
-    "download_attachment",   # ← ДОБАВЬ ЭТО
-}
-
-@app.before_request
-def force_auth_for_all():
-    if current_user.is_authenticated:
-        return
-    # ← доп. защита по пути, чтобы точно пропускать любой /uploads/ даже если endpoint не определился
-    if request.path.startswith("/uploads/"):
-        return
-    endpoint = (request.endpoint or "")
-    if endpoint in PUBLIC_ENDPOINTS or endpoint.startswith("static"):
-        return
-    return redirect(url_for("login", next=request.url))
-
 @app.route("/admin/deadlines/<int:deadline_id>/edit", methods=["GET", "POST"])
 @admin_required
 def admin_deadline_edit(deadline_id):
@@ -608,7 +792,7 @@ def admin_deadline_edit(deadline_id):
         subject = (request.form.get("subject") or "").strip() or None
         kind = (request.form.get("kind") or d.kind or "дз").strip().lower()
         link = _clean_url(request.form.get("link"))
-        if kind not in DEADLINE_TYPES:
+        if kind not in _DEADLINE_TYPES_SET:
             kind = d.kind or "дз"
 
         if not title or not date:
@@ -664,6 +848,15 @@ def admin_deadline_delete(deadline_id):
     flash("Дедлайн удалён 🗑️", "success")
     return redirect(url_for("admin_deadlines_list"))
 
+@app.post("/admin/scores/refresh")
+@admin_required
+def admin_scores_refresh():
+    clear_sheets_cache()
+    # бот — отдельный процесс со своим кэшем: он перечитает листы сам (SHEETS_REFRESH_INTERVAL в bot.py)
+    flash("Кэш баллов на сайте сброшен — таблицы перечитаются при следующем запросе. "
+          "Бот обновляет баллы сам, раз в 10 минут", "success")
+    return redirect(url_for("admin_panel"))
+
 # ======================= Auth =======================
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -705,6 +898,9 @@ def login():
         password = request.form["password"]
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             login_user(user, remember=True)
             flash("Добро пожаловать!", "success")
             next_url = request.args.get("next")
@@ -713,9 +909,17 @@ def login():
     return render_template("auth/login.html")
 
 # ---- Скачивание вложений (единый маршрут) ----
+# /uploads/<id>/<fname> — поиск по первичному ключу; старые ссылки без id
+# (уже разосланные в календари) ищутся по индексу ix_deadline_file_path
+@app.get("/uploads/<int:deadline_id>/<path:fname>")
 @app.get("/uploads/<path:fname>")
-def download_attachment(fname):
-    dl = Deadline.query.filter_by(file_path=fname).first()
+def download_attachment(fname, deadline_id=None):
+    if deadline_id is not None:
+        dl = db.session.get(Deadline, deadline_id)
+        if dl and dl.file_path != fname:
+            dl = None
+    else:
+        dl = Deadline.query.filter_by(file_path=fname).first()
     if not dl:
         abort(404)
     return send_from_directory(
@@ -739,30 +943,10 @@ def logout():
 @app.get("/api/scores")
 @login_required
 def api_scores():
-    results = []
     surname = current_user.surname
-    for sheet in SHEETS:
-        try:
-            csv_url = gsheet_to_csv_url(sheet["url"])
-            rows = fetch_csv_rows(csv_url)
-            found = find_score_by_surname(
-                rows,
-                surname,
-                prefer_total=sheet.get("prefer_total", False),
-                sum_until_total=sheet.get("sum_until_total", False),
-                take_last_total=sheet.get("take_last_total", False),
-            )
-            if found:
-                results.append({
-                    "name": sheet["name"],
-                    "score": round(found["sum"], 3),
-                    "ok": True
-                })
-            else:
-                results.append({"name": sheet["name"], "score": None, "ok": False})
-        except Exception as e:
-            results.append({"name": sheet["name"], "score": None, "ok": False, "error": str(e)})
-    return jsonify({"surname": surname, "items": results, "ts": datetime.utcnow().isoformat(timespec="seconds")})
+    # порядок карточек сохраняется: map отдаёт результаты в порядке SHEETS
+    results = list(_SHEETS_POOL.map(lambda sheet: score_for_sheet(sheet, surname), SHEETS))
+    return jsonify({"surname": surname, "items": results, "ts": datetime.now(UTC).isoformat(timespec="seconds")})
 
 # ======================= Errors =======================
 @app.errorhandler(403)
@@ -774,68 +958,52 @@ def not_found(e):
     return render_template("errors/404.html"), 404
 
 # ======================= DB init / light migrations =======================
+# Колонки и индексы, появившиеся после первых релизов: имя -> DDL
+_MIGRATION_COLUMNS = {
+    "user": {
+        "surname": 'ALTER TABLE "user" ADD COLUMN surname VARCHAR(120) NOT NULL DEFAULT \'\'',
+        "is_admin": 'ALTER TABLE "user" ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE',
+        "tg_id": 'ALTER TABLE "user" ADD COLUMN tg_id BIGINT',
+        "tg_username": 'ALTER TABLE "user" ADD COLUMN tg_username VARCHAR(255)',
+    },
+    "deadline": {
+        "kind": "ALTER TABLE deadline ADD COLUMN kind VARCHAR(30) NOT NULL DEFAULT 'дз'",
+        "link": "ALTER TABLE deadline ADD COLUMN link VARCHAR(500)",
+        "file_path": "ALTER TABLE deadline ADD COLUMN file_path VARCHAR(500)",
+        "file_name": "ALTER TABLE deadline ADD COLUMN file_name VARCHAR(255)",
+        "file_size": "ALTER TABLE deadline ADD COLUMN file_size INTEGER",
+        "file_mime": "ALTER TABLE deadline ADD COLUMN file_mime VARCHAR(120)",
+    },
+}
+# create_all не добавляет индексы в уже существующие таблицы
+# tg_id без unique: один чат может быть привязан к нескольким аккаунтам
+_MIGRATION_INDEXES = {
+    "user": {
+        "ix_user_tg_id": 'CREATE INDEX ix_user_tg_id ON "user" (tg_id)',
+    },
+    "deadline": {
+        "ix_deadline_due_at": "CREATE INDEX ix_deadline_due_at ON deadline (due_at)",
+        "ix_deadline_file_path": "CREATE INDEX ix_deadline_file_path ON deadline (file_path)",
+    },
+}
+
 with app.app_context():
     db.create_all()
     insp = inspect(db.engine)
 
-    # ---- USER ----
-    ucols = {c["name"] for c in insp.get_columns("user")}
-    if "surname" not in ucols:
-        db.session.execute(text(
-            'ALTER TABLE "user" ADD COLUMN surname VARCHAR(120) NOT NULL DEFAULT \'\''
-        ))
-        db.session.commit()
-
-    if "is_admin" not in ucols:
-        db.session.execute(text(
-            'ALTER TABLE "user" ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE'
-        ))
-        db.session.commit()
-
-    if "tg_id" not in ucols:
-        db.session.execute(text(
-            'ALTER TABLE "user" ADD COLUMN tg_id BIGINT'
-        ))
-        db.session.commit()
-
-    if "tg_username" not in ucols:
-        db.session.execute(text(
-            'ALTER TABLE "user" ADD COLUMN tg_username VARCHAR(255)'
-        ))
-        db.session.commit()
-
-    # ---- DEADLINE ----
-    dcols = {c["name"] for c in insp.get_columns("deadline")}
-    if "kind" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN kind VARCHAR(30) NOT NULL DEFAULT 'дз'"
-        ))
-        db.session.commit()
-    if "link" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN link VARCHAR(500)"
-        ))
-        db.session.commit()
-    if "file_path" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN file_path VARCHAR(500)"
-        ))
-        db.session.commit()
-    if "file_name" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN file_name VARCHAR(255)"
-        ))
-        db.session.commit()
-    if "file_size" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN file_size INTEGER"
-        ))
-        db.session.commit()
-    if "file_mime" not in dcols:
-        db.session.execute(text(
-            "ALTER TABLE deadline ADD COLUMN file_mime VARCHAR(120)"
-        ))
-        db.session.commit()
+    needed: list[str] = []
+    for table, columns in _MIGRATION_COLUMNS.items():
+        existing = {c["name"] for c in insp.get_columns(table)}
+        needed += [sql for name, sql in columns.items() if name not in existing]
+    for table, indexes in _MIGRATION_INDEXES.items():
+        existing = {i["name"] for i in insp.get_indexes(table)}
+        needed += [sql for name, sql in indexes.items() if name not in existing]
+
+    # одна транзакция на все изменения вместо commit на каждый ALTER
+    if needed:
+        with db.engine.begin() as conn:
+            for sql in needed:
+                conn.execute(text(sql))
 
 # ======================= Entry =======================
 if __name__ == "__main__":
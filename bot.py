@@ -1,43 +1,187 @@
 from __future__ import annotations
 import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from datetime import datetime, timedelta, time
-from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 load_dotenv()
 
 from telegram import Update
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes
 )
 
 # импорт из твоего Flask-приложения
-from app import db, app, User, Deadline, SHEETS, gsheet_to_csv_url, fetch_csv_rows, find_score_by_surname
+from app import (
+    db, app, User, Deadline, SHEETS, MSK_TZ,
+    gsheet_to_csv_url, get_sheet, find_score_by_surname, format_deadline_title,
+)
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
 
-TZ = ZoneInfo("Europe/Moscow")
+TZ = MSK_TZ  # та же зона, что и на сайте
+
+log = logging.getLogger(__name__)
+
+# requests блокирующий: таблицы качаем в потоках, чтобы event loop бота не вставал
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sheets")
+
+# последние удачно скачанные листы (name -> индекс из get_sheet); обновляет job_refresh_sheets,
+# а /scores только ищет в них фамилию и в сеть не ходит
+_SHEETS_CACHE: dict[str, dict] = {}
+# бот работает отдельным процессом (Procfile: bot), поэтому кнопка «сбросить кэш баллов» в админке
+# его не касается: свежие баллы в /scores появятся не позже чем через этот интервал
+SHEETS_REFRESH_INTERVAL = 600  # секунд
+
+# tg_id привязанных чатов: грузится при старте и раз в сутки (сводка), пополняется в /bind,
+# чтобы почасовые напоминания не ходили каждый раз в таблицу user
+LINKED_TG_IDS: set[int] = set()
+# чаты, куда доставка невозможна (бот заблокирован, чат удалён) — в рассылки больше не берём
+DEAD_TG_IDS: set[int] = set()
 
 # ================= helpers =================
-def _fmt_deadline(d: Deadline) -> str:
-    when = d.due_at.strftime("%d.%m.%Y") if d.all_day else d.due_at.strftime("%d.%m.%Y %H:%M")
-    tag = f"[{d.kind}]" if d.kind else ""
-    subj = f"{d.subject}: " if d.subject else ""
-    return f"• {when} — {tag} {subj}{d.title}".strip()
+def _with_session(handler):
+    """Контекст Flask один на весь процесс (см. main), а сессию БД закрываем после каждого апдейта/джоба."""
+    @wraps(handler)
+    async def wrapped(*args, **kwargs):
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            db.session.remove()
+    return wrapped
+
+def _load_linked_tg_ids() -> None:
+    ids = db.session.execute(
+        db.select(User.tg_id).where(User.tg_id.isnot(None))
+    ).scalars().all()
+    LINKED_TG_IDS.clear()
+    LINKED_TG_IDS.update(ids)
+
+# Для текста рассылок нужны только эти поля — ORM-объекты целиком не тянем
+_FMT_COLUMNS = (Deadline.due_at, Deadline.all_day, Deadline.kind, Deadline.subject, Deadline.title)
+
+_DATE_FMT = "%d.%m.%Y"
+_DATETIME_FMT = "%d.%m.%Y %H:%M"
+
+def _fmt_deadline(d) -> str:
+    """d — Deadline или строка select(*_FMT_COLUMNS)."""
+    when = format(d.due_at, _DATE_FMT if d.all_day else _DATETIME_FMT)
+    return f"• {when} — {format_deadline_title(d)}"
+
+def _load_sheet(sheet: dict) -> dict:
+    return get_sheet(gsheet_to_csv_url(sheet["url"]))
+
+def _score_in(sheet: dict, data: dict, surname: str) -> dict | None:
+    return find_score_by_surname(
+        data["rows"],
+        surname,
+        prefer_total=sheet.get("prefer_total", False),
+        sum_until_total=sheet.get("sum_until_total", False),
+        take_last_total=sheet.get("take_last_total", False),
+        index=data,
+    )
 
 async def _require_linked(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> User | None:
     chat_id = update.effective_chat.id
-    with app.app_context():
-        u = User.query.filter_by(tg_id=chat_id).first()
-        if not u:
-            await update.effective_message.reply_text(
-                "Этот чат ещё не привязан к аккаунту.\n"
-                "Отправь команду: /bind <твой_логин_на_сайте>\n\n"
-                "Пример: /bind ivanov"
-            )
-            return None
-        return u
+    u = db.session.execute(
+        db.select(User).where(User.tg_id == chat_id).limit(1)
+    ).scalars().first()
+    if not u:
+        await update.effective_message.reply_text(
+            "Этот чат ещё не привязан к аккаунту.\n"
+            "Отправь команду: /bind <твой_логин_на_сайте>\n\n"
+            "Пример: /bind ivanov"
+        )
+        return None
+    return u
+
+TG_MESSAGE_LIMIT = 4096  # символов в одном сообщении Telegram
+
+def _split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> list[str]:
+    """Режет длинный текст на сообщения по границам строк (то есть по дедлайнам)."""
+    parts: list[str] = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:  # одна строка длиннее лимита — режем как есть
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+# Сколько дедлайнов максимум попадает в /next и в почасовое напоминание
+NEXT_LIMIT = 30
+REMINDER_LIMIT = 50
+
+# Telegram режет массовые рассылки примерно на 30 сообщениях в секунду
+TG_BROADCAST_RATE = 25
+# чаты отдаются отправителям через очередь такого размера, а не все разом
+BROADCAST_QUEUE_SIZE = 100
+
+def _is_dead_chat(exc: BaseException) -> bool:
+    if isinstance(exc, Forbidden):
+        return True
+    return isinstance(exc, BadRequest) and "chat not found" in exc.message.lower()
+
+def _forget_chats(chat_ids: list[int]) -> None:
+    """Отвязывает мёртвые чаты: чтобы снова получать рассылку, нужен новый /bind."""
+    DEAD_TG_IDS.update(chat_ids)
+    LINKED_TG_IDS.difference_update(chat_ids)
+    db.session.execute(
+        db.update(User).where(User.tg_id.in_(chat_ids)).values(tg_id=None, tg_username=None)
+    )
+    db.session.commit()
+
+async def _broadcast(bot, chat_ids: list[int], text: str, rate: int = TG_BROADCAST_RATE) -> None:
+    """Шлёт text во все чаты: `rate` отправителей разбирают очередь, каждый не чаще раза в секунду."""
+    parts = _split_message(text)
+    queue: asyncio.Queue[int] = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+    dead: list[int] = []
+
+    async def sender():
+        while True:
+            cid = await queue.get()
+            try:
+                # части одного сообщения шлёт один и тот же отправитель — порядок не путается
+                for part in parts:
+                    try:
+                        await bot.send_message(chat_id=cid, text=part)
+                    except Exception as e:
+                        # прочие ошибки (сеть, флуд-контроль) не повод отвязывать чат — пропускаем
+                        if _is_dead_chat(e):
+                            dead.append(cid)
+                            break
+                    finally:
+                        await asyncio.sleep(1.0)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(sender()) for _ in range(min(rate, len(chat_ids)))]
+    try:
+        for cid in chat_ids:
+            if cid not in DEAD_TG_IDS:
+                await queue.put(cid)
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    if dead:
+        _forget_chats(dead)
 
 # ========= on-demand commands =========
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -53,6 +197,7 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await cmd_start(update, ctx)
 
+@_with_session
 async def cmd_bind(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if len(ctx.args) != 1:
         await update.message.reply_text("Использование: /bind <логин>\nНапример: /bind ivanov")
@@ -60,36 +205,46 @@ async def cmd_bind(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     login = ctx.args[0].strip().lower()
     chat = update.effective_chat
 
-    with app.app_context():
-        u = User.query.filter_by(username=login).first()
-        if not u:
-            await update.message.reply_text("Пользователь с таким логином не найден.")
-            return
-        u.tg_id = chat.id
-        u.tg_username = chat.username or None
-        db.session.commit()
+    u = db.session.execute(
+        db.select(User).where(User.username == login)
+    ).scalars().first()
+    if not u:
+        await update.message.reply_text("Пользователь с таким логином не найден.")
+        return
+    prev_tg_id = u.tg_id
+    u.tg_id = chat.id
+    u.tg_username = chat.username or None
+    db.session.commit()
+    LINKED_TG_IDS.add(chat.id)
+    DEAD_TG_IDS.discard(chat.id)
+    if prev_tg_id and prev_tg_id != chat.id:
+        still_linked = db.session.execute(
+            db.select(User.id).where(User.tg_id == prev_tg_id).limit(1)
+        ).first()
+        if not still_linked:
+            LINKED_TG_IDS.discard(prev_tg_id)
 
     await update.message.reply_text("Готово! Аккаунт привязан ✅")
 
+@_with_session
 async def cmd_next(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = await _require_linked(update, ctx)
     if not u:
         return
     now = datetime.now(TZ)
     horizon = now + timedelta(days=10)
-    with app.app_context():
-        items = (
-            Deadline.query
-            .filter(Deadline.due_at >= now, Deadline.due_at <= horizon)
-            .order_by(Deadline.due_at.asc())
-            .all()
-        )
+    items = db.session.execute(
+        db.select(*_FMT_COLUMNS)
+        .where(Deadline.due_at >= now, Deadline.due_at < horizon)
+        .order_by(Deadline.due_at.asc())
+        .limit(NEXT_LIMIT)
+    ).all()
     if not items:
         await update.message.reply_text("На ближайшие 10 дней дедлайнов нет 🎉")
         return
-    text_lines = ["Ближайшие дедлайны:\n"] + [_fmt_deadline(d) for d in items[:30]]
-    await update.message.reply_text("\n".join(text_lines))
+    await update.message.reply_text("Ближайшие дедлайны:\n\n" + "\n".join(_fmt_deadline(d) for d in items))
 
+@_with_session
 async def cmd_scores(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = await _require_linked(update, ctx)
     if not u:
@@ -99,22 +254,15 @@ async def cmd_scores(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     results = []
     errors = []
     for sheet in SHEETS:
-        try:
-            csv_url = gsheet_to_csv_url(sheet["url"])
-            rows = fetch_csv_rows(csv_url)
-            found = find_score_by_surname(
-                rows,
-                surname,
-                prefer_total=sheet.get("prefer_total", False),
-                sum_until_total=sheet.get("sum_until_total", False),
-                take_last_total=sheet.get("take_last_total", False),
-            )
-            if found:
-                results.append(f"• {sheet['name']}: {round(found['sum'], 3)}")
-            else:
-                results.append(f"• {sheet['name']}: —")
-        except Exception as e:
-            errors.append(f"{sheet['name']}: {e}")
+        data = _SHEETS_CACHE.get(sheet["name"])
+        if data is None:
+            errors.append(f"{sheet['name']}: баллы ещё не загружены, попробуй чуть позже")
+            continue
+        found = _score_in(sheet, data, surname)
+        if found:
+            results.append(f"• {sheet['name']}: {round(found['sum'], 3)}")
+        else:
+            results.append(f"• {sheet['name']}: —")
 
     if results:
         await update.message.reply_text("Твои баллы:\n" + "\n".join(results))
@@ -124,94 +272,117 @@ async def cmd_scores(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Ошибки:\n" + "\n".join(errors[:5]))
 
 # ========= scheduled jobs (через JobQueue) =========
+async def job_refresh_sheets(ctx: ContextTypes.DEFAULT_TYPE):
+    """Перекачивает все листы для /scores (параллельно, в потоках)."""
+    loop = asyncio.get_running_loop()
+    answers = await asyncio.gather(
+        *(loop.run_in_executor(_SHEETS_POOL, _load_sheet, sheet) for sheet in SHEETS),
+        return_exceptions=True,
+    )
+    failed = []
+    for sheet, data in zip(SHEETS, answers):
+        if isinstance(data, Exception):
+            # старая копия листа остаётся в кэше до следующей удачной загрузки
+            failed.append(f"{sheet['name']}: {data}")
+        else:
+            _SHEETS_CACHE[sheet["name"]] = data
+    if failed:
+        log.warning("Не удалось обновить листы: %s", "; ".join(failed))
+
+@_with_session
 async def job_daily_digest(ctx: ContextTypes.DEFAULT_TYPE):
     """Ежедневная сводка: дедлайны на сегодня и на завтра для всех привязанных пользователей."""
-    now = datetime.now(TZ)
-    today_start = datetime.combine(now.date(), time(0, 0), tzinfo=TZ)
+    # due_at в БД наивный (время МСК), поэтому все границы — тоже без tzinfo:
+    # иначе драйвер (psycopg) отправит их как timestamptz и сдвинет окно на пояс сессии
+    now = datetime.now(TZ).replace(tzinfo=None)
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     tomorrow_start = today_start + timedelta(days=1)
     after_tomorrow_start = tomorrow_start + timedelta(days=1)
 
-    with app.app_context():
-        users = User.query.filter(User.tg_id.isnot(None)).all()
-
-        # забираем дедлайны на сегодня/завтра разом, чтобы не гонять БД в цикле
-        todays = (
-            Deadline.query
-            .filter(Deadline.due_at >= today_start, Deadline.due_at < tomorrow_start)
-            .order_by(Deadline.due_at.asc())
-            .all()
-        )
-        tomorrows = (
-            Deadline.query
-            .filter(Deadline.due_at >= tomorrow_start, Deadline.due_at < after_tomorrow_start)
-            .order_by(Deadline.due_at.asc())
-            .all()
-        )
+    # раз в сутки сверяем кэш привязок с БД (например, если юзера удалили на сайте)
+    _load_linked_tg_ids()
+
+    # сегодня и завтра — одним запросом по индексу ix_deadline_due_at, делим на лету
+    # строки форматируем сразу, пока читаем результат: каждая — ровно один раз
+    todays, tomorrows = [], []
+    rows = db.session.execute(
+        db.select(*_FMT_COLUMNS)
+        .where(Deadline.due_at >= today_start, Deadline.due_at < after_tomorrow_start)
+        .order_by(Deadline.due_at.asc())
+        .execution_options(yield_per=500)
+    )
+    for d in rows:
+        (todays if d.due_at < tomorrow_start else tomorrows).append(_fmt_deadline(d))
+    # рассылка идёт долго (users/25 секунд) — соединение на это время в пул возвращаем
+    db.session.remove()
 
-    txt_today = "На сегодня дедлайны:\n" + "\n".join(_fmt_deadline(d) for d in todays) if todays else "Сегодня дедлайнов нет 🎉"
-    txt_tomorrow = "На завтра дедлайны:\n" + "\n".join(_fmt_deadline(d) for d in tomorrows) if tomorrows else "На завтра дедлайнов нет 🎉"
+    txt_today = "На сегодня дедлайны:\n" + "\n".join(todays) if todays else "Сегодня дедлайнов нет 🎉"
+    txt_tomorrow = "На завтра дедлайны:\n" + "\n".join(tomorrows) if tomorrows else "На завтра дедлайнов нет 🎉"
 
-    for u in users:
-        # отправляем раздельными сообщениями, чтобы было читабельно
-        try:
-            await ctx.bot.send_message(chat_id=u.tg_id, text=txt_today)
-            await ctx.bot.send_message(chat_id=u.tg_id, text=txt_tomorrow)
-        except Exception:
-            # молча пропускаем (например, если юзер закрыл личку боту)
-            pass
+    # сегодня и завтра — одним сообщением: вдвое меньше запросов к Telegram
+    await _broadcast(ctx.bot, list(LINKED_TG_IDS), f"{txt_today}\n\n{txt_tomorrow}")
 
+@_with_session
 async def job_hourly_reminders(ctx: ContextTypes.DEFAULT_TYPE):
     """Каждый час напоминаем о дедлайнах, которые начнутся в ближайшие 24 часа."""
     now = datetime.now(TZ)
     soon = now + timedelta(hours=24)
-    with app.app_context():
-        users = User.query.filter(User.tg_id.isnot(None)).all()
-        upcoming = (
-            Deadline.query
-            .filter(Deadline.due_at >= now, Deadline.due_at <= soon)
-            .order_by(Deadline.due_at.asc())
-            .all()
-        )
+    upcoming = db.session.execute(
+        db.select(*_FMT_COLUMNS)
+        .where(Deadline.due_at >= now, Deadline.due_at < soon)
+        .order_by(Deadline.due_at.asc())
+        .limit(REMINDER_LIMIT)
+    ).all()
+    # как и в сводке: на время рассылки сессию не держим
+    db.session.remove()
 
     if not upcoming:
         return
 
-    text_lines = ["Напоминание: дедлайны в ближайшие 24 часа:\n"] + [_fmt_deadline(d) for d in upcoming[:50]]
-    msg = "\n".join(text_lines)
-    for u in users:
-        try:
-            await ctx.bot.send_message(chat_id=u.tg_id, text=msg)
-        except Exception:
-            pass
+    msg = "Напоминание: дедлайны в ближайшие 24 часа:\n\n" + "\n".join(_fmt_deadline(d) for d in upcoming)
+    await _broadcast(ctx.bot, list(LINKED_TG_IDS), msg)
 
 # ========= app entry =========
 def main():
-    app_ = Application.builder().token(TOKEN).build()
-
-    # команды
-    app_.add_handler(CommandHandler("start", cmd_start))
-    app_.add_handler(CommandHandler("help", cmd_help))
-    app_.add_handler(CommandHandler("bind", cmd_bind))
-    app_.add_handler(CommandHandler("next", cmd_next))
-    app_.add_handler(CommandHandler("scores", cmd_scores))
-    app_.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, cmd_help))  # простая помощь
-
-    # планировщик
-    # Ежедневная сводка в 09:00 по МСК
-    app_.job_queue.run_daily(
-        job_daily_digest,
-        time=time(9, 0, tzinfo=TZ),
-        name="daily_digest_msk"
-    )
-    # Почасовое напоминание на 24 часа вперёд
-    app_.job_queue.run_repeating(
-        job_hourly_reminders,
-        interval=3600,  # секунд
-        first=10,       # через 10 секунд после старта
-        name="hourly_reminders"
-    )
+    # один app_context на всё время работы бота вместо push/pop на каждое сообщение
+    with app.app_context():
+        _load_linked_tg_ids()
+        # загрузка идёт мимо _with_session — сами возвращаем соединение в пул,
+        # иначе транзакция висит открытой до первого апдейта или джоба
+        db.session.remove()
+        app_ = Application.builder().token(TOKEN).build()
+
+        # команды
+        app_.add_handler(CommandHandler("start", cmd_start))
+        app_.add_handler(CommandHandler("help", cmd_help))
+        app_.add_handler(CommandHandler("bind", cmd_bind))
+        app_.add_handler(CommandHandler("next", cmd_next))
+        app_.add_handler(CommandHandler("scores", cmd_scores))
+        app_.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, cmd_help))  # простая помощь
+
+        # планировщик
+        # Ежедневная сводка в 09:00 по МСК
+        app_.job_queue.run_daily(
+            job_daily_digest,
+            time=time(9, 0, tzinfo=TZ),
+            name="daily_digest_msk"
+        )
+        # Листы для /scores: сразу при старте и дальше каждые 10 минут
+        app_.job_queue.run_repeating(
+            job_refresh_sheets,
+            interval=SHEETS_REFRESH_INTERVAL,
+            first=0,
+            name="refresh_sheets"
+        )
+        # Почасовое напоминание на 24 часа вперёд
+        app_.job_queue.run_repeating(
+            job_hourly_reminders,
+            interval=3600,  # секунд
+            first=10,       # через 10 секунд после старта
+            name="hourly_reminders"
+        )
 
-    app_.run_polling(allowed_updates=Update.ALL_TYPES)
+        app_.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()